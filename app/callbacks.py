@@ -0,0 +1,215 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import tempfile
+import time
+import uuid
+from urllib.parse import urlencode
+
+# Public base URL n8n uses to reach this backend, e.g. https://api.example.com
+N8N_CALLBACK_BASE_URL = os.getenv("N8N_CALLBACK_BASE_URL")
+N8N_CALLBACK_SECRET = os.getenv("N8N_CALLBACK_SECRET")
+# How long n8n has to push a result back
+N8N_CALLBACK_TIMEOUT = float(os.getenv("N8N_CALLBACK_TIMEOUT", "120"))
+# How long the resumed pipeline (fetch, Kumiko, encoding) may run once the callback arrived
+N8N_CALLBACK_PIPELINE_TIMEOUT = float(os.getenv("N8N_CALLBACK_PIPELINE_TIMEOUT", str(N8N_CALLBACK_TIMEOUT)))
+# How long the outbound call may take to be acknowledged in callback mode
+N8N_CALLBACK_ACK_TIMEOUT = float(os.getenv("N8N_CALLBACK_ACK_TIMEOUT", "15"))
+# How long finished jobs are kept so results can be fetched and duplicates recognised
+CALLBACK_JOB_TTL = float(os.getenv("CALLBACK_JOB_TTL", "600"))
+# Job state shared by every worker process; must be the same directory for all of them
+N8N_CALLBACK_STATE_DIR = os.getenv(
+    "N8N_CALLBACK_STATE_DIR",
+    os.path.join(tempfile.gettempdir(), "nemube_callbacks")
+)
+
+PENDING = "pending"
+PROCESSING = "processing"
+DONE = "done"
+FAILED = "failed"
+TIMED_OUT = "timed_out"
+
+# Seconds between sweeps of expired job files
+_PRUNE_INTERVAL = 60
+
+
+class CallbackRegistry:
+    """
+    Tracks in-flight n8n generations and resumes their pipeline when the
+    signed callback arrives.
+
+    Jobs are JSON files in a state directory, so any worker can accept a
+    callback or report a job's state. Pipelines are registered by kind in
+    every worker and receive the parameters stored with the job.
+    """
+
+    def __init__(self, base_url, secret, state_dir=N8N_CALLBACK_STATE_DIR, timeout=N8N_CALLBACK_TIMEOUT,
+                 pipeline_timeout=N8N_CALLBACK_PIPELINE_TIMEOUT, ttl=CALLBACK_JOB_TTL):
+        self.base_url = base_url.rstrip("/") if base_url else None
+        self.secret = secret
+        self.state_dir = state_dir
+        self.timeout = timeout
+        self.pipeline_timeout = pipeline_timeout
+        self.ttl = ttl
+        self._handlers = {}
+        self._tasks = set()
+        self._last_prune = 0.0
+
+    @property
+    def enabled(self):
+        return bool(self.base_url and self.secret)
+
+    def register(self, kind, handler):
+        """
+        Register the pipeline for a kind of job.
+        handler(params, content_type, content) runs when the callback arrives.
+        """
+        self._handlers[kind] = handler
+
+    def sign(self, correlation_id, expires):
+        message = f"{correlation_id}.{expires}".encode("utf-8")
+        return hmac.new(self.secret.encode("utf-8"), message, hashlib.sha256).hexdigest()
+
+    def verify(self, correlation_id, expires, signature):
+        """
+        Check the callback signature; expiry is checked separately so late
+        callbacks can be told apart from forged ones
+        """
+        if not self.secret or not signature:
+            return False
+        return hmac.compare_digest(self.sign(correlation_id, expires), signature)
+
+    def create(self, kind, params):
+        """
+        Register a job and return it with the signed callback URL handed to n8n
+        """
+        if kind not in self._handlers:
+            raise ValueError(f"No callback handler registered for {kind}")
+
+        os.makedirs(self.state_dir, exist_ok=True)
+        self._prune()
+
+        correlation_id = uuid.uuid4().hex
+        expires = int(time.time() + self.timeout)
+        query = urlencode({"expires": expires, "signature": self.sign(correlation_id, expires)})
+        job = {
+            "correlation_id": correlation_id,
+            "kind": kind,
+            "params": params,
+            "state": PENDING,
+            "created_at": time.time(),
+            "expires_at": expires,
+        }
+        self._write(job)
+        job["callback_url"] = f"{self.base_url}/api/n8n-callback/{correlation_id}?{query}"
+        return job
+
+    def get(self, correlation_id):
+        """
+        Current job state, or None if unknown. Pending jobs past their deadline
+        are reported as timed out, and pipelines that never finished (e.g. the
+        worker running them died) as failed.
+        """
+        try:
+            with open(self._job_path(correlation_id), "r") as f:
+                job = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        now = time.time()
+        if job["state"] == PENDING and now > job["expires_at"]:
+            job["state"] = TIMED_OUT
+        elif job["state"] == PROCESSING and now > self._pipeline_deadline(job):
+            job["state"] = FAILED
+            job["error"] = "Pipeline did not finish in time"
+            job["finished_at"] = self._pipeline_deadline(job)
+        return job
+
+    def discard(self, job):
+        """
+        Forget a job whose outbound request never reached n8n
+        """
+        for path in (self._job_path(job["correlation_id"]), self._claim_path(job["correlation_id"])):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def deliver(self, job, content_type, content):
+        """
+        Hand a callback payload to its job.
+        Returns "accepted", "duplicate" or "late".
+        """
+        if job["state"] == TIMED_OUT:
+            return "late"
+
+        # The claim file makes the first callback win across all workers
+        try:
+            os.close(os.open(self._claim_path(job["correlation_id"]), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return "duplicate"
+
+        job["state"] = PROCESSING
+        job["processing_started_at"] = time.time()
+        self._write(job)
+
+        # Resume the pipeline without holding the callback request open
+        task = asyncio.create_task(self._run(job, content_type, content))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return "accepted"
+
+    async def _run(self, job, content_type, content):
+        handler = self._handlers[job["kind"]]
+        try:
+            job["result"] = await asyncio.wait_for(
+                handler(job["params"], content_type, content),
+                timeout=self.pipeline_timeout
+            )
+            job["state"] = DONE
+        except asyncio.TimeoutError:
+            print(f"❌ Callback pipeline {job['correlation_id']}: timed out")
+            job["state"] = FAILED
+            job["error"] = "Pipeline did not finish in time"
+        except Exception as e:
+            print(f"❌ Callback pipeline {job['correlation_id']}: {type(e).__name__} - {str(e)}")
+            job["state"] = FAILED
+            job["error"] = str(e)
+        job["finished_at"] = time.time()
+        self._write(job)
+
+    def _pipeline_deadline(self, job):
+        return job.get("processing_started_at", job["expires_at"]) + self.pipeline_timeout
+
+    def _job_path(self, correlation_id):
+        return os.path.join(self.state_dir, f"{correlation_id}.json")
+
+    def _claim_path(self, correlation_id):
+        return os.path.join(self.state_dir, f"{correlation_id}.claim")
+
+    def _write(self, job):
+        path = self._job_path(job["correlation_id"])
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({k: v for k, v in job.items() if k != "callback_url"}, f)
+        os.replace(tmp_path, path)
+
+    def _prune(self):
+        now = time.time()
+        if now - self._last_prune < _PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+
+        for name in os.listdir(self.state_dir):
+            if not name.endswith(".json"):
+                continue
+            correlation_id = name[:-len(".json")]
+            job = self.get(correlation_id)
+            if job is None:
+                continue
+            # get() has already turned stale pending/processing jobs into final states
+            ended_at = job.get("finished_at") or job["expires_at"]
+            if job["state"] not in (PENDING, PROCESSING) and now - ended_at > self.ttl:
+                self.discard(job)
+
+
+callback_registry = CallbackRegistry(N8N_CALLBACK_BASE_URL, N8N_CALLBACK_SECRET)
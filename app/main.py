@@ -1,10 +1,21 @@
+import asyncio
 import base64
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 import subprocess
 import os
 import sys
+import time
 from app.routers import n8n_processor
+from app.callbacks import N8N_CALLBACK_ACK_TIMEOUT, callback_registry
+from app.scheduler import (
+    BULK,
+    INTERACTIVE,
+    client_id_from_request,
+    segmentation_scheduler,
+    upstream_scheduler,
+)
 import json
 import httpx
 from typing import List, Optional
@@ -33,6 +44,21 @@ N8N_REGENERATE_WEBHOOK_URL = os.getenv("N8N_REGENERATE_WEBHOOK_URL")
 KUMIKO_PATH = os.getenv("KUMIKO_PATH", "/Users/wangruijie/projects/hackharvard/kumiko/kumiko")
 TEST_IMAGE_PATH = os.getenv("TEST_IMAGE_PATH", "test.png")
 
+async def load_image_bytes(image_data, image_source="bytes"):
+    """
+    Resolve image data from a URL, base64 string or raw bytes into bytes
+    """
+    if image_source == "url":
+        async with httpx.AsyncClient() as client:
+            img_response = await client.get(image_data)
+            img_response.raise_for_status()
+            return img_response.content
+    elif image_source == "base64":
+        if image_data.startswith("data:image"):
+            image_data = image_data.split(",")[1]
+        return base64.b64decode(image_data)
+    return image_data
+
 async def process_image_with_kumiko(image_data, image_source="bytes"):
     """
     Process image with Kumiko to extract panels and coordinates
@@ -48,17 +74,7 @@ async def process_image_with_kumiko(image_data, image_source="bytes"):
         temp_image_path = f"temp_storyboard_{uuid.uuid4().hex}.png"
 
         # Fetch/decode image based on source
-        if image_source == "url":
-            async with httpx.AsyncClient() as client:
-                img_response = await client.get(image_data)
-                img_response.raise_for_status()
-                image_bytes = img_response.content
-        elif image_source == "base64":
-            if image_data.startswith("data:image"):
-                image_data = image_data.split(",")[1]
-            image_bytes = base64.b64decode(image_data)
-        else:
-            image_bytes = image_data
+        image_bytes = await load_image_bytes(image_data, image_source)
 
         # Save image locally
         with open(temp_image_path, 'wb') as f:
@@ -71,7 +87,8 @@ async def process_image_with_kumiko(image_data, image_source="bytes"):
         kumiko_path = os.path.abspath(KUMIKO_PATH)
         python_executable = sys.executable
         command = [python_executable, kumiko_path, "-i", temp_image_path, "--save-panels", panel_output_dir]
-        result = subprocess.run(command, capture_output=True, text=True)
+        # Run off the event loop so queued requests keep being scheduled
+        result = await asyncio.to_thread(subprocess.run, command, capture_output=True, text=True)
 
         if result.returncode != 0:
             return {"error": f"Kumiko processing failed: {result.stderr}"}
@@ -129,8 +146,390 @@ async def process_image_with_kumiko(image_data, image_source="bytes"):
         print(f"❌ Kumiko error: {type(e).__name__} - {str(e)}")
         return {"error": str(e)}
 
+# Padding around the edited region so Kumiko can still see the panel borders
+RESEGMENT_MARGIN = int(os.getenv("RESEGMENT_MARGIN", "16"))
+
+def _box_intersection_area(a, b):
+    """Area of the overlap between two [x, y, w, h] boxes"""
+    width = min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0])
+    height = min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1])
+    return max(0, width) * max(0, height)
+
+def _touches_crop_edge(panel, region, page_size):
+    """Whether a detection reaches a side of the region that was cut out of the page"""
+    x, y, w, h = panel
+    rx, ry, rw, rh = region
+    page_width, page_height = page_size
+    return (
+        (x <= rx + 1 and rx > 0)
+        or (y <= ry + 1 and ry > 0)
+        or (x + w >= rx + rw - 1 and rx + rw < page_width)
+        or (y + h >= ry + rh - 1 and ry + rh < page_height)
+    )
+
+def merge_region_panels(coordinates, region_panels, region, page_size, panel_index=None):
+    """
+    Replace the panels that belong to a re-segmented region with the new detections.
+
+    A previous panel is replaced when it is the edited panel or when most of it
+    lies inside the region. Detections that are clipped by the crop, or that
+    mostly cover a panel being kept, are parts of neighbours and are dropped.
+    New panels are inserted where the first replaced panel used to be, so
+    untouched panels keep their relative order.
+    Returns (updated_coordinates, affected_indices).
+    """
+    replaced = []
+    for idx, panel in enumerate(coordinates):
+        area = panel[2] * panel[3]
+        if idx == panel_index or (area > 0 and _box_intersection_area(panel, region) > area / 2):
+            replaced.append(idx)
+
+    kept = [p for i, p in enumerate(coordinates) if i not in replaced]
+    region_panels = [
+        p for p in region_panels
+        if not _touches_crop_edge(p, region, page_size)
+        and not any(_box_intersection_area(p, k) > p[2] * p[3] / 2 for k in kept)
+    ]
+
+    # Keep the old layout if nothing was detected inside the region
+    if not region_panels:
+        return [list(p) for p in coordinates], []
+
+    new_panels = sorted(region_panels, key=lambda p: (p[1], p[0]))
+    insert_at = replaced[0] if replaced else len(coordinates)
+
+    kept_before = [list(p) for i, p in enumerate(coordinates) if i < insert_at and i not in replaced]
+    kept_after = [list(p) for i, p in enumerate(coordinates) if i >= insert_at and i not in replaced]
+    updated = kept_before + new_panels + kept_after
+
+    affected_indices = list(range(len(kept_before), len(kept_before) + len(new_panels)))
+    return updated, affected_indices
+
+async def resegment_region_with_kumiko(image_data, coordinates, panel_index=None, mask_bbox=None, image_source="bytes"):
+    """
+    Re-run Kumiko on only the region of a page that changed
+    Returns updated coordinates and crops of the affected panels only
+    """
+    temp_image_path = None
+    try:
+        import tempfile
+        import cv2
+        import numpy as np
+
+        image_bytes = await load_image_bytes(image_data, image_source)
+        page = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if page is None:
+            return {"error": "Could not decode page image"}
+        page_height, page_width = page.shape[:2]
+
+        # Region to re-detect: the edited panel, grown to cover the mask
+        boxes = []
+        if panel_index is not None:
+            if not 0 <= panel_index < len(coordinates):
+                return {"error": f"panel_index {panel_index} out of range for {len(coordinates)} panels"}
+            boxes.append(coordinates[panel_index])
+        if mask_bbox:
+            boxes.append(mask_bbox)
+        if not boxes:
+            return {"error": "Either panel_index or mask_bbox is required"}
+
+        x0 = max(0, min(b[0] for b in boxes) - RESEGMENT_MARGIN)
+        y0 = max(0, min(b[1] for b in boxes) - RESEGMENT_MARGIN)
+        x1 = min(page_width, max(b[0] + b[2] for b in boxes) + RESEGMENT_MARGIN)
+        y1 = min(page_height, max(b[1] + b[3] for b in boxes) + RESEGMENT_MARGIN)
+        if x1 <= x0 or y1 <= y0:
+            return {"error": "Region lies outside the page"}
+        region = [x0, y0, x1 - x0, y1 - y0]
+
+        # Save only the cropped region for Kumiko processing
+        fd, temp_image_path = tempfile.mkstemp(prefix="temp_region_", suffix=".png")
+        os.close(fd)
+        cv2.imwrite(temp_image_path, page[y0:y1, x0:x1])
+
+        kumiko_path = os.path.abspath(KUMIKO_PATH)
+        command = [sys.executable, kumiko_path, "-i", temp_image_path]
+        # Run off the event loop so queued requests keep being scheduled
+        result = await asyncio.to_thread(subprocess.run, command, capture_output=True, text=True)
+
+        if result.returncode != 0:
+            return {"error": f"Kumiko processing failed: {result.stderr}"}
+
+        kumiko_json = json.loads(result.stdout.strip().split('\n')[0])
+
+        # Shift region-local panels back into page coordinates
+        region_panels = [
+            [p[0] + x0, p[1] + y0, p[2], p[3]]
+            for p in kumiko_json[0]['panels']
+        ]
+
+        coordinates, affected_indices = merge_region_panels(
+            coordinates, region_panels, region, [page_width, page_height], panel_index
+        )
+
+        # Encode crops for the affected panels only, in the order of affected_indices
+        panel_images = []
+        for idx in affected_indices:
+            x, y, w, h = coordinates[idx]
+            ok, encoded = cv2.imencode(".png", page[y:y + h, x:x + w])
+            if not ok:
+                return {"error": f"Could not encode panel {idx}"}
+            panel_base64 = base64.b64encode(encoded.tobytes()).decode('utf-8')
+            panel_images.append(f"data:image/png;base64,{panel_base64}")
+
+        # No usable detection inside the region: the old layout is returned
+        # unchanged and the client should re-segment the whole page instead
+        fallback = not affected_indices
+        if fallback:
+            print(f"⚠️ Kumiko: No usable panels in region {region}, kept previous layout")
+        else:
+            print(f"✅ Kumiko: Re-segmented region {region}, {len(affected_indices)} panels updated")
+
+        return {
+            "fallback": fallback,
+            "coordinates": coordinates,
+            "panels": panel_images,
+            "affected_indices": affected_indices,
+            "region": region,
+            "total_size": [page_width, page_height],
+            "panel_count": len(coordinates),
+        }
+
+    except Exception as e:
+        print(f"❌ Kumiko error: {type(e).__name__} - {str(e)}")
+        return {"error": str(e)}
+    finally:
+        if temp_image_path and os.path.exists(temp_image_path):
+            os.remove(temp_image_path)
+
+async def finish_story_board(content_type, content, status_code, client_id):
+    """
+    Extract the story board image from an n8n result and segment it with Kumiko
+    Shared by the direct n8n response and the callback receiver
+    """
+    # Check if response is JSON or binary image
+    if 'application/json' in content_type:
+        n8n_data = json.loads(content)
+    elif 'image/' in content_type:
+        n8n_data = {"binary_image": True}
+    else:
+        try:
+            n8n_data = json.loads(content)
+        except:
+            n8n_data = {"binary_image": True}
+
+    # Extract image from n8n response
+    image_to_process = None
+    image_source = None
+
+    if n8n_data.get("binary_image"):
+        image_to_process = content
+        image_source = "bytes"
+    elif "image_url" in n8n_data:
+        image_to_process = n8n_data["image_url"]
+        image_source = "url"
+    elif "image" in n8n_data:
+        if isinstance(n8n_data["image"], str) and n8n_data["image"].startswith("http"):
+            image_to_process = n8n_data["image"]
+            image_source = "url"
+        elif isinstance(n8n_data["image"], str):
+            image_to_process = n8n_data["image"]
+            image_source = "base64"
+    elif "result" in n8n_data:
+        if isinstance(n8n_data["result"], str):
+            if n8n_data["result"].startswith("http"):
+                image_to_process = n8n_data["result"]
+                image_source = "url"
+            else:
+                image_to_process = n8n_data["result"]
+                image_source = "base64"
+    elif "data" in n8n_data:
+        image_to_process = n8n_data["data"]
+        image_source = "base64"
+    elif "output" in n8n_data:
+        image_to_process = n8n_data["output"]
+        image_source = "base64"
+
+    if not image_to_process:
+        return {
+            "status": "error",
+            "message": "n8n response received but no image data found",
+            "n8n_data": n8n_data
+        }
+
+    # Process image with Kumiko
+    async with segmentation_scheduler.slot(BULK, client_id):
+        kumiko_result = await process_image_with_kumiko(image_to_process, image_source)
+
+    if kumiko_result.get("error"):
+        return {
+            "status": "error",
+            "message": "Story board generated but Kumiko processing failed",
+            "n8n_data": n8n_data,
+            "error": kumiko_result["error"]
+        }
+
+    # Return complete panel information to frontend
+    print(f"✅ Success: Generated {kumiko_result['panel_count']} panels")
+    return {
+        "status": "success",
+        "message": "Story board generated and processed successfully",
+        "n8n_data": n8n_data,
+        "final_image": kumiko_result["original_image"],
+        "panels": kumiko_result["panels"],
+        "coordinates": kumiko_result["coordinates"],
+        "total_size": kumiko_result["total_size"],
+        "panel_count": kumiko_result["panel_count"],
+        "n8n_status_code": status_code
+    }
+
+async def finish_regenerate_panel(content_type, content, status_code, panel_index):
+    """
+    Extract the regenerated panel image from an n8n result
+    Shared by the direct n8n response and the callback receiver
+    """
+    # Handle different response types
+    if 'image/' in content_type:
+        # Binary image response
+        image_bytes = content
+        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+        ext = content_type.split('/')[-1]
+        mime_type = f'image/{ext}'
+        regenerated_image = f"data:{mime_type};base64,{image_base64}"
+
+        print(f"✅ Panel {panel_index} regenerated successfully (binary)")
+        return {
+            "status": "success",
+            "panel_index": panel_index,
+            "regenerated_image": regenerated_image,
+            "n8n_status_code": status_code
+        }
+
+    elif 'application/json' in content_type:
+        # JSON response
+        n8n_data = json.loads(content)
+
+        # Extract image from various possible JSON formats
+        regenerated_image = None
+
+        if "image" in n8n_data:
+            regenerated_image = n8n_data["image"]
+        elif "regenerated_image" in n8n_data:
+            regenerated_image = n8n_data["regenerated_image"]
+        elif "result" in n8n_data:
+            regenerated_image = n8n_data["result"]
+        elif "data" in n8n_data:
+            regenerated_image = n8n_data["data"]
+        elif "output" in n8n_data:
+            regenerated_image = n8n_data["output"]
+        elif "image_url" in n8n_data:
+            # If it's a URL, fetch the image
+            async with httpx.AsyncClient() as img_client:
+                img_response = await img_client.get(n8n_data["image_url"])
+                img_response.raise_for_status()
+                image_bytes = img_response.content
+                image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+                regenerated_image = f"data:image/png;base64,{image_base64}"
+
+        if not regenerated_image:
+            raise HTTPException(
+                status_code=500,
+                detail=f"n8n response received but no image data found in JSON: {list(n8n_data.keys())}"
+            )
+
+        # Ensure base64 format
+        if not regenerated_image.startswith("data:image"):
+            if regenerated_image.startswith("http"):
+                # It's a URL, fetch it
+                async with httpx.AsyncClient() as img_client:
+                    img_response = await img_client.get(regenerated_image)
+                    img_response.raise_for_status()
+                    image_bytes = img_response.content
+                    image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+                    regenerated_image = f"data:image/png;base64,{image_base64}"
+            else:
+                # Assume it's raw base64
+                regenerated_image = f"data:image/png;base64,{regenerated_image}"
+
+        print(f"✅ Panel {panel_index} regenerated successfully (JSON)")
+        return {
+            "status": "success",
+            "panel_index": panel_index,
+            "regenerated_image": regenerated_image,
+            "n8n_data": n8n_data,
+            "n8n_status_code": status_code
+        }
+
+    else:
+        # Try to parse as JSON anyway
+        try:
+            n8n_data = json.loads(content)
+            return {
+                "status": "success",
+                "panel_index": panel_index,
+                "n8n_data": n8n_data,
+                "n8n_status_code": status_code
+            }
+        except:
+            # Treat as binary image
+            image_bytes = content
+            image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+            regenerated_image = f"data:image/png;base64,{image_base64}"
+
+            print(f"✅ Panel {panel_index} regenerated successfully (binary fallback)")
+            return {
+                "status": "success",
+                "panel_index": panel_index,
+                "regenerated_image": regenerated_image,
+                "n8n_status_code": status_code
+            }
+
+# Pipelines resumed by the callback receiver, registered in every worker
+callback_registry.register(
+    "story_board",
+    lambda params, content_type, content: finish_story_board(content_type, content, None, params["client_id"])
+)
+callback_registry.register(
+    "regenerate_panel",
+    lambda params, content_type, content: finish_regenerate_panel(content_type, content, None, params["panel_index"])
+)
+
+# Keys under which n8n returns a finished image, in either response format
+N8N_RESULT_KEYS = ("image", "image_url", "regenerated_image", "result", "data", "output")
+
+def ack_carries_result(response):
+    """
+    Whether a callback-mode acknowledgement already holds the generated image,
+    e.g. because the workflow answers synchronously instead of calling back
+    """
+    content_type = response.headers.get('content-type', '')
+    if 'image/' in content_type:
+        return True
+    try:
+        ack = json.loads(response.content)
+    except ValueError:
+        return False
+    return isinstance(ack, dict) and any(ack.get(key) for key in N8N_RESULT_KEYS)
+
+def callback_accepted(request, callback_job, n8n_status_code):
+    """
+    202 response telling the client where to poll for a callback-mode result
+    """
+    correlation_id = callback_job["correlation_id"]
+    print(f"⏳ Accepted, waiting for n8n callback {correlation_id}")
+    return JSONResponse(
+        status_code=202,
+        content={
+            "status": "accepted",
+            "correlation_id": correlation_id,
+            "status_url": str(request.url_for("n8n_callback_status", correlation_id=correlation_id)),
+            "expires_at": callback_job["expires_at"],
+            "n8n_status_code": n8n_status_code
+        }
+    )
+
 @app.post("/api/get-story-board")
 async def get_story_board(
+    request: Request,
     prompt: str = Form(...),
     panels: str = Form(...),
     style: str = Form(...),
@@ -179,6 +578,7 @@ async def get_story_board(
             detail="Cannot have more character names than character images"
         )
 
+    client_id = client_id_from_request(request)
     print(f"📨 Request: {panels} panels, {style} style, {len(illustration_images)} refs, {len(character_images)} chars")
 
     if not N8N_WEBHOOK_URL:
@@ -218,90 +618,43 @@ async def get_story_board(
             names.append(name)
         data["character_names"] = names
 
-        # Forward to n8n webhook
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(
-                N8N_WEBHOOK_URL,
-                data=data,
-                files=files
-            )
-            response.raise_for_status()
-
-            # Check if response is JSON or binary image
-            content_type = response.headers.get('content-type', '')
-            if 'application/json' in content_type:
-                n8n_data = response.json()
-            elif 'image/' in content_type:
-                n8n_data = {"binary_image": True}
-            else:
-                try:
-                    n8n_data = response.json()
-                except:
-                    n8n_data = {"binary_image": True}
-
-            # Extract image from n8n response
-            image_to_process = None
-            image_source = None
-
-            if n8n_data.get("binary_image"):
-                image_to_process = response.content
-                image_source = "bytes"
-            elif "image_url" in n8n_data:
-                image_to_process = n8n_data["image_url"]
-                image_source = "url"
-            elif "image" in n8n_data:
-                if isinstance(n8n_data["image"], str) and n8n_data["image"].startswith("http"):
-                    image_to_process = n8n_data["image"]
-                    image_source = "url"
-                elif isinstance(n8n_data["image"], str):
-                    image_to_process = n8n_data["image"]
-                    image_source = "base64"
-            elif "result" in n8n_data:
-                if isinstance(n8n_data["result"], str):
-                    if n8n_data["result"].startswith("http"):
-                        image_to_process = n8n_data["result"]
-                        image_source = "url"
-                    else:
-                        image_to_process = n8n_data["result"]
-                        image_source = "base64"
-            elif "data" in n8n_data:
-                image_to_process = n8n_data["data"]
-                image_source = "base64"
-            elif "output" in n8n_data:
-                image_to_process = n8n_data["output"]
-                image_source = "base64"
-
-            if not image_to_process:
-                return {
-                    "status": "error",
-                    "message": "n8n response received but no image data found",
-                    "n8n_data": n8n_data
-                }
-
-            # Process image with Kumiko
-            kumiko_result = await process_image_with_kumiko(image_to_process, image_source)
-
-            if kumiko_result.get("error"):
-                return {
-                    "status": "error",
-                    "message": "Story board generated but Kumiko processing failed",
-                    "n8n_data": n8n_data,
-                    "error": kumiko_result["error"]
-                }
-
-            # Return complete panel information to frontend
-            print(f"✅ Success: Generated {kumiko_result['panel_count']} panels")
-            return {
-                "status": "success",
-                "message": "Story board generated and processed successfully",
-                "n8n_data": n8n_data,
-                "final_image": kumiko_result["original_image"],
-                "panels": kumiko_result["panels"],
-                "coordinates": kumiko_result["coordinates"],
-                "total_size": kumiko_result["total_size"],
-                "panel_count": kumiko_result["panel_count"],
-                "n8n_status_code": response.status_code
-            }
+        # In callback mode n8n only acknowledges here and pushes the image later
+        callback_job = None
+        if callback_registry.enabled:
+            callback_job = callback_registry.create("story_board", {"client_id": client_id})
+            data["callback_url"] = callback_job["callback_url"]
+            data["correlation_id"] = callback_job["correlation_id"]
+
+        # Forward to n8n webhook (bulk priority, yields to interactive edits)
+        try:
+            async with httpx.AsyncClient(timeout=N8N_CALLBACK_ACK_TIMEOUT if callback_job else 120.0) as client:
+                async with upstream_scheduler.slot(BULK, client_id):
+                    response = await client.post(
+                        N8N_WEBHOOK_URL,
+                        data=data,
+                        files=files
+                    )
+                response.raise_for_status()
+        except Exception:
+            if callback_job:
+                callback_registry.discard(callback_job)
+            raise
+
+        if callback_job and ack_carries_result(response):
+            # The workflow answered with the image; finish now instead of waiting for a callback
+            print(f"⚠️ n8n returned a result instead of an ack for {callback_job['correlation_id']}, finishing directly")
+            callback_registry.discard(callback_job)
+            callback_job = None
+
+        if callback_job:
+            return callback_accepted(request, callback_job, response.status_code)
+
+        return await finish_story_board(
+            response.headers.get('content-type', ''),
+            response.content,
+            response.status_code,
+            client_id
+        )
 
     except httpx.HTTPStatusError as e:
         print(f"❌ n8n HTTP error: {e.response.status_code}")
@@ -324,6 +677,7 @@ async def get_story_board(
 
 @app.post("/api/regenerate-panel")
 async def regenerate_panel(
+    request: Request,
     original_image: UploadFile = File(...),
     mask_image: UploadFile = File(...),
     prompt: str = Form(...),
@@ -374,114 +728,44 @@ async def regenerate_panel(
             "style": style
         }
         
+        # In callback mode n8n only acknowledges here and pushes the image later
+        callback_job = None
+        if callback_registry.enabled:
+            callback_job = callback_registry.create("regenerate_panel", {"panel_index": panel_index})
+            data["callback_url"] = callback_job["callback_url"]
+            data["correlation_id"] = callback_job["correlation_id"]
+
         # Forward to n8n webhook with extended timeout for image generation
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(
-                N8N_REGENERATE_WEBHOOK_URL,
-                data=data,
-                files=files
-            )
-            response.raise_for_status()
-            
-            # Check response content type
-            content_type = response.headers.get('content-type', '')
-            
-            # Handle different response types
-            if 'image/' in content_type:
-                # Binary image response
-                image_bytes = response.content
-                image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-                ext = content_type.split('/')[-1]
-                mime_type = f'image/{ext}'
-                regenerated_image = f"data:{mime_type};base64,{image_base64}"
-                
-                print(f"✅ Panel {panel_index} regenerated successfully (binary)")
-                return {
-                    "status": "success",
-                    "panel_index": panel_index,
-                    "regenerated_image": regenerated_image,
-                    "n8n_status_code": response.status_code
-                }
-            
-            elif 'application/json' in content_type:
-                # JSON response
-                n8n_data = response.json()
-                
-                # Extract image from various possible JSON formats
-                regenerated_image = None
-                
-                if "image" in n8n_data:
-                    regenerated_image = n8n_data["image"]
-                elif "regenerated_image" in n8n_data:
-                    regenerated_image = n8n_data["regenerated_image"]
-                elif "result" in n8n_data:
-                    regenerated_image = n8n_data["result"]
-                elif "data" in n8n_data:
-                    regenerated_image = n8n_data["data"]
-                elif "output" in n8n_data:
-                    regenerated_image = n8n_data["output"]
-                elif "image_url" in n8n_data:
-                    # If it's a URL, fetch the image
-                    async with httpx.AsyncClient() as img_client:
-                        img_response = await img_client.get(n8n_data["image_url"])
-                        img_response.raise_for_status()
-                        image_bytes = img_response.content
-                        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-                        regenerated_image = f"data:image/png;base64,{image_base64}"
-                
-                if not regenerated_image:
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"n8n response received but no image data found in JSON: {list(n8n_data.keys())}"
+        try:
+            async with httpx.AsyncClient(timeout=N8N_CALLBACK_ACK_TIMEOUT if callback_job else 120.0) as client:
+                async with upstream_scheduler.slot(INTERACTIVE, client_id_from_request(request)):
+                    response = await client.post(
+                        N8N_REGENERATE_WEBHOOK_URL,
+                        data=data,
+                        files=files
                     )
-                
-                # Ensure base64 format
-                if not regenerated_image.startswith("data:image"):
-                    if regenerated_image.startswith("http"):
-                        # It's a URL, fetch it
-                        async with httpx.AsyncClient() as img_client:
-                            img_response = await img_client.get(regenerated_image)
-                            img_response.raise_for_status()
-                            image_bytes = img_response.content
-                            image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-                            regenerated_image = f"data:image/png;base64,{image_base64}"
-                    else:
-                        # Assume it's raw base64
-                        regenerated_image = f"data:image/png;base64,{regenerated_image}"
-                
-                print(f"✅ Panel {panel_index} regenerated successfully (JSON)")
-                return {
-                    "status": "success",
-                    "panel_index": panel_index,
-                    "regenerated_image": regenerated_image,
-                    "n8n_data": n8n_data,
-                    "n8n_status_code": response.status_code
-                }
-            
-            else:
-                # Try to parse as JSON anyway
-                try:
-                    n8n_data = response.json()
-                    return {
-                        "status": "success",
-                        "panel_index": panel_index,
-                        "n8n_data": n8n_data,
-                        "n8n_status_code": response.status_code
-                    }
-                except:
-                    # Treat as binary image
-                    image_bytes = response.content
-                    image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-                    regenerated_image = f"data:image/png;base64,{image_base64}"
-                    
-                    print(f"✅ Panel {panel_index} regenerated successfully (binary fallback)")
-                    return {
-                        "status": "success",
-                        "panel_index": panel_index,
-                        "regenerated_image": regenerated_image,
-                        "n8n_status_code": response.status_code
-                    }
-    
+                response.raise_for_status()
+        except Exception:
+            if callback_job:
+                callback_registry.discard(callback_job)
+            raise
+
+        if callback_job and ack_carries_result(response):
+            # The workflow answered with the image; finish now instead of waiting for a callback
+            print(f"⚠️ n8n returned a result instead of an ack for {callback_job['correlation_id']}, finishing directly")
+            callback_registry.discard(callback_job)
+            callback_job = None
+
+        if callback_job:
+            return callback_accepted(request, callback_job, response.status_code)
+
+        return await finish_regenerate_panel(
+            response.headers.get('content-type', ''),
+            response.content,
+            response.status_code,
+            panel_index
+        )
+
     except httpx.HTTPStatusError as e:
         print(f"❌ n8n HTTP error: {e.response.status_code}")
         raise HTTPException(
@@ -501,6 +785,166 @@ async def regenerate_panel(
             detail=f"Error processing panel regeneration: {str(e)}"
         )
 
+@app.post("/api/n8n-callback/{correlation_id}")
+async def n8n_callback(correlation_id: str, request: Request, expires: int = 0, signature: str = ""):
+    """
+    Receiver for n8n results in callback mode. n8n posts the generated image
+    (binary or JSON, same formats as a direct response) to the signed URL it
+    was given, and the pipeline resumes from here. The result is stored for
+    the client to fetch from the status URL.
+
+    Args:
+        correlation_id: Id of the generation, from the callback URL
+        expires: Expiry timestamp signed into the callback URL
+        signature: HMAC signature of correlation_id and expires
+    """
+    if not callback_registry.verify(correlation_id, expires, signature):
+        raise HTTPException(status_code=403, detail="Invalid callback signature")
+
+    job = callback_registry.get(correlation_id)
+    if job is None:
+        if time.time() > expires:
+            raise HTTPException(status_code=410, detail="Callback arrived after the job expired")
+        raise HTTPException(status_code=404, detail="Unknown correlation id")
+
+    content = await request.body()
+    outcome = callback_registry.deliver(job, request.headers.get('content-type', ''), content)
+
+    if outcome == "late":
+        print(f"⌛ Late n8n callback {correlation_id}")
+        raise HTTPException(status_code=410, detail="Callback arrived after the job timed out")
+
+    # Duplicates are acknowledged so n8n does not keep retrying
+    print(f"📬 n8n callback {correlation_id}: {outcome}")
+    return {"status": outcome, "correlation_id": correlation_id}
+
+@app.get("/api/n8n-callback/{correlation_id}")
+async def n8n_callback_status(correlation_id: str):
+    """
+    State of a callback-mode generation. Clients poll the status_url they got
+    with the 202 response until state is done, failed or timed_out. The
+    random correlation id is the only credential needed.
+    """
+    job = callback_registry.get(correlation_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown correlation id")
+
+    response = {
+        "correlation_id": correlation_id,
+        "kind": job["kind"],
+        "state": job["state"],
+        "expires_at": job["expires_at"]
+    }
+    if "result" in job:
+        response["result"] = job["result"]
+    if "error" in job:
+        response["error"] = job["error"]
+    return response
+
+@app.post("/api/resegment-panel")
+async def resegment_panel(
+    request: Request,
+    page_image: UploadFile = File(...),
+    coordinates: str = Form(...),
+    panel_index: Optional[int] = Form(default=None),
+    mask_bbox: Optional[str] = Form(default=None)
+):
+    """
+    Endpoint to update panel geometry after a single panel was regenerated,
+    re-detecting panels only inside the changed region.
+
+    Args:
+        page_image: The full page with the regenerated panel composited in
+        coordinates: JSON list of previous panels as [x, y, width, height]
+        panel_index: Index of the panel that was regenerated
+        mask_bbox: Optional JSON [x, y, width, height] of the edit in page coordinates
+    """
+    try:
+        previous_coordinates = json.loads(coordinates)
+        parsed_bbox = json.loads(mask_bbox) if mask_bbox else None
+    except json.JSONDecodeError:
+        raise HTTPException(
+            status_code=400,
+            detail="coordinates and mask_bbox must be valid JSON"
+        )
+
+    def is_box(value):
+        return (
+            isinstance(value, list)
+            and len(value) == 4
+            and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in value)
+            and value[2] >= 0
+            and value[3] >= 0
+        )
+
+    if not isinstance(previous_coordinates, list) or not all(is_box(p) for p in previous_coordinates):
+        raise HTTPException(
+            status_code=400,
+            detail="coordinates must be a list of numeric [x, y, width, height]"
+        )
+
+    if parsed_bbox is not None and not is_box(parsed_bbox):
+        raise HTTPException(
+            status_code=400,
+            detail="mask_bbox must be numeric [x, y, width, height]"
+        )
+
+    if panel_index is None and parsed_bbox is None:
+        raise HTTPException(
+            status_code=400,
+            detail="Either panel_index or mask_bbox is required"
+        )
+
+    if panel_index is not None and not 0 <= panel_index < len(previous_coordinates):
+        raise HTTPException(
+            status_code=400,
+            detail=f"panel_index must be between 0 and {len(previous_coordinates) - 1}"
+        )
+
+    previous_coordinates = [[int(v) for v in p] for p in previous_coordinates]
+    parsed_bbox = [int(v) for v in parsed_bbox] if parsed_bbox else None
+
+    print(f"✂️ Re-segmenting around panel {panel_index}")
+
+    page_content = await page_image.read()
+    async with segmentation_scheduler.slot(INTERACTIVE, client_id_from_request(request)):
+        kumiko_result = await resegment_region_with_kumiko(
+            page_content,
+            previous_coordinates,
+            panel_index=panel_index,
+            mask_bbox=parsed_bbox
+        )
+
+    if kumiko_result.get("error"):
+        raise HTTPException(
+            status_code=500,
+            detail=f"Kumiko re-segmentation failed: {kumiko_result['error']}"
+        )
+
+    if kumiko_result["fallback"]:
+        return {
+            "status": "fallback",
+            "message": "No usable panels detected in the changed region; previous layout kept, re-segment the full page",
+            "panel_index": panel_index,
+            **kumiko_result
+        }
+
+    return {
+        "status": "success",
+        "panel_index": panel_index,
+        **kumiko_result
+    }
+
+@app.get("/api/scheduler-stats")
+async def scheduler_stats():
+    """
+    Queue depth and wait times per priority class for upstream calls and segmentation
+    """
+    return {
+        "upstream": upstream_scheduler.snapshot(),
+        "segmentation": segmentation_scheduler.snapshot(),
+    }
+
 @app.get("/process-image")
 async def process_image():
     try:
@@ -0,0 +1,230 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+# Priority classes, lower rank is served first
+INTERACTIVE = "interactive"
+BULK = "bulk"
+DEFAULT_CLASS_RANKS = {INTERACTIVE: 0, BULK: 2}
+
+# Seconds of waiting that lower a class's rank by one, so bulk work still progresses
+SCHEDULER_AGING_SECONDS = float(os.getenv("SCHEDULER_AGING_SECONDS", "10"))
+
+# Slots bulk work can never take, so an edit never waits behind a full board generation
+INTERACTIVE_RESERVED_SLOTS = int(os.getenv("INTERACTIVE_RESERVED_SLOTS", "1"))
+
+# Proxies allowed to name the client via X-Client-Id, comma separated
+TRUSTED_PROXIES = {h.strip() for h in os.getenv("TRUSTED_PROXIES", "").split(",") if h.strip()}
+
+# Fair-share weights per client key, e.g. "10.0.0.5=2,10.0.0.9=0.5"; unlisted clients weigh 1
+SCHEDULER_CLIENT_WEIGHTS = {
+    key.strip(): float(value)
+    for key, _, value in (
+        item.partition("=") for item in os.getenv("SCHEDULER_CLIENT_WEIGHTS", "").split(",") if "=" in item
+    )
+}
+
+# Cap on per-client tags kept between prunes
+_MAX_CLIENT_TAGS = 1024
+
+
+class PriorityScheduler:
+    """
+    Concurrency limiter with priority classes, fair queuing across clients
+    within a class, and aging across classes.
+
+    Each class may be capped below the total concurrency; by default bulk
+    work leaves INTERACTIVE_RESERVED_SLOTS free for interactive requests.
+    Within a class each client gets a virtual finish tag advanced by
+    1 / weight per job, so one client submitting many jobs cannot starve
+    another and a client with weight 2 gets twice the share of one with 1. Across classes with free
+    capacity the lowest rank wins, where a class's rank drops the longer its
+    oldest waiter has been queued.
+    """
+
+    def __init__(self, name, concurrency, class_ranks=None, class_limits=None, client_weights=None, aging_seconds=SCHEDULER_AGING_SECONDS):
+        self.name = name
+        self._ranks = dict(class_ranks or DEFAULT_CLASS_RANKS)
+        # The configured concurrency is a hard cap; the reservation shrinks to fit
+        self.concurrency = max(1, int(concurrency))
+        if class_limits is None:
+            reserved = min(max(0, INTERACTIVE_RESERVED_SLOTS), self.concurrency - 1)
+            class_limits = {BULK: self.concurrency - reserved}
+        self.aging_seconds = aging_seconds
+        self._client_weights = dict(SCHEDULER_CLIENT_WEIGHTS if client_weights is None else client_weights)
+        self._limits = {c: min(self.concurrency, class_limits.get(c, self.concurrency)) for c in self._ranks}
+        self._in_use = 0
+        self._class_in_use = {c: 0 for c in self._ranks}
+        self._seq = itertools.count()
+        # Each waiter sits in a tag-ordered heap (who is next) and an arrival-ordered deque (aging)
+        self._queues = {c: [] for c in self._ranks}
+        self._arrivals = {c: deque() for c in self._ranks}
+        self._virtual_time = {c: 0.0 for c in self._ranks}
+        self._client_tags = {c: {} for c in self._ranks}
+        self._stats = {
+            c: {"dispatched": 0, "total_wait": 0.0, "max_wait": 0.0, "recent": deque(maxlen=256)}
+            for c in self._ranks
+        }
+
+    @asynccontextmanager
+    async def slot(self, priority, client_id="anonymous"):
+        """
+        Wait for a slot in the given priority class and hold it for the block
+        """
+        await self._acquire(priority, client_id)
+        try:
+            yield
+        finally:
+            self._release(priority)
+
+    async def _acquire(self, priority, client_id):
+        if priority not in self._queues:
+            raise ValueError(f"Unknown priority class: {priority}")
+
+        enqueued_at = time.monotonic()
+        tag = self._next_tag(priority, client_id)
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (tag, next(self._seq), enqueued_at, future)
+        heapq.heappush(self._queues[priority], entry)
+        self._arrivals[priority].append(entry)
+
+        # Free capacity in this class is handed out immediately, even if another class is queued
+        self._dispatch()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot may have been handed over just before cancellation
+            if future.done() and not future.cancelled():
+                self._release(priority)
+            else:
+                future.cancel()
+            raise
+
+        self._record_wait(priority, time.monotonic() - enqueued_at)
+
+    def _has_capacity(self, priority):
+        return self._in_use < self.concurrency and self._class_in_use[priority] < self._limits[priority]
+
+    def _take(self, priority):
+        self._in_use += 1
+        self._class_in_use[priority] += 1
+
+    def _release(self, priority):
+        self._in_use -= 1
+        self._class_in_use[priority] -= 1
+        self._dispatch()
+
+    def _next_tag(self, priority, client_id):
+        tags = self._client_tags[priority]
+        start = max(self._virtual_time[priority], tags.get(client_id, 0.0))
+        tag = start + 1.0 / self._weight(client_id)
+        tags[client_id] = tag
+
+        if len(tags) > _MAX_CLIENT_TAGS:
+            # Tags at or behind virtual time would restart from it anyway
+            current = self._virtual_time[priority]
+            for key in [k for k, v in tags.items() if v <= current]:
+                del tags[key]
+        return tag
+
+    def _weight(self, client_id):
+        # Clients named through a trusted proxy ("host/id") fall back to the host's weight
+        weight = self._client_weights.get(client_id)
+        if weight is None:
+            weight = self._client_weights.get(client_id.split("/", 1)[0], 1.0)
+        return max(weight, 1e-3)
+
+    def _purge(self, priority):
+        queue = self._queues[priority]
+        while queue and queue[0][3].done():
+            heapq.heappop(queue)
+        arrivals = self._arrivals[priority]
+        while arrivals and arrivals[0][3].done():
+            arrivals.popleft()
+
+    def _dispatch(self):
+        while self._in_use < self.concurrency:
+            now = time.monotonic()
+            best = None
+            for priority, queue in self._queues.items():
+                self._purge(priority)
+                if not queue or not self._has_capacity(priority):
+                    continue
+                # Age the class by its oldest waiter, not by whoever is next in tag order
+                oldest = self._arrivals[priority][0][2]
+                waited = now - oldest
+                rank = self._ranks[priority] - (waited / self.aging_seconds if self.aging_seconds > 0 else 0)
+                key = (rank, oldest)
+                if best is None or key < best[0]:
+                    best = (key, priority)
+
+            if best is None:
+                return
+
+            priority = best[1]
+            tag, _, _, future = heapq.heappop(self._queues[priority])
+            self._virtual_time[priority] = tag
+            self._take(priority)
+            future.set_result(None)
+
+    def _record_wait(self, priority, waited):
+        stats = self._stats[priority]
+        stats["dispatched"] += 1
+        stats["total_wait"] += waited
+        stats["max_wait"] = max(stats["max_wait"], waited)
+        stats["recent"].append(waited)
+
+    def snapshot(self):
+        """
+        Queue depth and wait times per priority class, in milliseconds
+        """
+        classes = {}
+        for priority, stats in self._stats.items():
+            recent = sorted(stats["recent"])
+            dispatched = stats["dispatched"]
+            classes[priority] = {
+                "queued": sum(1 for entry in self._queues[priority] if not entry[3].done()),
+                "in_use": self._class_in_use[priority],
+                "dispatched": dispatched,
+                "avg_wait_ms": round(stats["total_wait"] / dispatched * 1000, 2) if dispatched else 0.0,
+                "p95_wait_ms": round(recent[min(len(recent) - 1, int(len(recent) * 0.95))] * 1000, 2) if recent else 0.0,
+                "max_wait_ms": round(stats["max_wait"] * 1000, 2),
+            }
+        return {
+            "name": self.name,
+            "concurrency": self.concurrency,
+            "in_use": self._in_use,
+            "limits": dict(self._limits),
+            "classes": classes,
+        }
+
+
+# Shared schedulers for outbound n8n calls and Kumiko segmentation jobs
+upstream_scheduler = PriorityScheduler(
+    "upstream",
+    int(os.getenv("UPSTREAM_CONCURRENCY", "4"))
+)
+segmentation_scheduler = PriorityScheduler(
+    "segmentation",
+    int(os.getenv("SEGMENTATION_CONCURRENCY", str(os.cpu_count() or 2)))
+)
+
+
+def client_id_from_request(request):
+    """
+    Identify the client for fair queuing by its remote address. X-Client-Id is
+    only honoured from TRUSTED_PROXIES, so callers cannot mint new ids to get
+    around per-client fairness.
+    """
+    host = request.client.host if request.client else "anonymous"
+    if host in TRUSTED_PROXIES:
+        client_id = request.headers.get("x-client-id")
+        if client_id:
+            return f"{host}/{client_id}"
+    return host
@@ -1,5 +1,48 @@
+import argparse
 import base64
+import hashlib
+import json
+import mmap
 import os
+import struct
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Base64 maps every 3 input bytes to 4 output characters, so chunks that are a
+# multiple of 3 can be encoded independently and concatenated without padding.
+CHUNK_SIZE = 3 * 256 * 1024
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp")
+MANIFEST_NAME = "manifest.json"
+
+def _open_mapped(image_path):
+    """
+    Memory-maps an image file read-only.
+
+    :param image_path: Path to the image file
+    :return: Tuple of (file object, mmap or None for empty files)
+    """
+    if not os.path.exists(image_path):
+        raise FileNotFoundError(f"The file {image_path} does not exist.")
+
+    image_file = open(image_path, "rb")
+    if os.fstat(image_file.fileno()).st_size == 0:
+        return image_file, None
+    return image_file, mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def iter_base64_chunks(data, chunk_size=CHUNK_SIZE):
+    """
+    Yields base64 encoded chunks of a bytes-like object.
+
+    :param data: Bytes-like object (bytes or mmap)
+    :param chunk_size: Input chunk size, must be a multiple of 3
+    """
+    if chunk_size % 3 != 0:
+        raise ValueError("chunk_size must be a multiple of 3")
+    view = memoryview(data)
+    try:
+        for start in range(0, len(view), chunk_size):
+            yield base64.b64encode(view[start:start + chunk_size])
+    finally:
+        view.release()
 
 def encode_image_to_base64(image_path):
     """
@@ -8,12 +51,15 @@ def encode_image_to_base64(image_path):
     :param image_path: Path to the image file
     :return: Base64 encoded string of the image
     """
-    if not os.path.exists(image_path):
-        raise FileNotFoundError(f"The file {image_path} does not exist.")
-    
-    with open(image_path, "rb") as image_file:
-        encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-    return encoded_string
+    image_file, mapped = _open_mapped(image_path)
+    try:
+        if mapped is None:
+            return ""
+        return b"".join(iter_base64_chunks(mapped)).decode('utf-8')
+    finally:
+        if mapped is not None:
+            mapped.close()
+        image_file.close()
 
 def save_image_bytes(image_path, output_path):
     """
@@ -22,33 +68,273 @@ def save_image_bytes(image_path, output_path):
     :param image_path: Path to the image file
     :param output_path: Path to the output file where image bytes will be saved
     """
-    if not os.path.exists(image_path):
-        raise FileNotFoundError(f"The file {image_path} does not exist.")
-    
-    # Read the image file as binary
-    with open(image_path, "rb") as image_file:
-        image_bytes = image_file.read()
-
-    # Save the binary data to a file
-    with open(output_path, "wb") as output_file:
-        output_file.write(image_bytes)
+    image_file, mapped = _open_mapped(image_path)
+    try:
+        # Copy in chunks so large files never sit fully in memory
+        with open(output_path, "wb") as output_file:
+            if mapped is not None:
+                view = memoryview(mapped)
+                for start in range(0, len(view), CHUNK_SIZE):
+                    output_file.write(view[start:start + CHUNK_SIZE])
+                view.release()
+    finally:
+        if mapped is not None:
+            mapped.close()
+        image_file.close()
 
     print(f"Image bytes saved to {output_path}")
 
-def main():
-    # Example usage
-    image_path = input("Enter the path to the image: ")
-    output_path = "image_bytes.bin"  # Default output file
+def read_image_dimensions(data):
+    """
+    Reads width and height from the header of a PNG, JPEG, GIF, BMP or WebP image.
+
+    :param data: Bytes-like object holding the image
+    :return: [width, height] or None if the format is not recognised
+    """
+    head = bytes(data[:32])
+
+    if head.startswith(b"\x89PNG\r\n\x1a\n") and len(head) >= 24:
+        return list(struct.unpack(">II", head[16:24]))
+
+    if head[:6] in (b"GIF87a", b"GIF89a") and len(head) >= 10:
+        return list(struct.unpack("<HH", head[6:10]))
+
+    if head.startswith(b"BM") and len(head) >= 26:
+        width, height = struct.unpack("<ii", head[18:26])
+        return [width, abs(height)]
+
+    if head.startswith(b"RIFF") and head[8:12] == b"WEBP" and len(head) >= 30:
+        chunk = head[12:16]
+        if chunk == b"VP8X":
+            width = int.from_bytes(head[24:27], "little") + 1
+            height = int.from_bytes(head[27:30], "little") + 1
+            return [width, height]
+        if chunk == b"VP8 ":
+            width, height = struct.unpack("<HH", head[26:30])
+            return [width & 0x3FFF, height & 0x3FFF]
+        if chunk == b"VP8L":
+            bits = int.from_bytes(head[21:25], "little")
+            return [(bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1]
+        return None
+
+    if head.startswith(b"\xff\xd8"):
+        # Walk JPEG segments until a start-of-frame marker
+        offset = 2
+        size = len(data)
+        while offset + 9 < size:
+            if data[offset] != 0xFF:
+                offset += 1
+                continue
+            marker = data[offset + 1]
+            if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7 or marker == 0xFF:
+                offset += 1 if marker == 0xFF else 2
+                continue
+            length = struct.unpack(">H", bytes(data[offset + 2:offset + 4]))[0]
+            if marker in (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF):
+                height, width = struct.unpack(">HH", bytes(data[offset + 5:offset + 9]))
+                return [width, height]
+            offset += 2 + length
+
+    return None
+
+# Hashes already in the manifest, set once per worker process by the pool initializer
+_known_hashes = frozenset()
+
+def _init_worker(known_hashes):
+    global _known_hashes
+    _known_hashes = frozenset(known_hashes)
+
+def process_image_file(image_path, output_dir):
+    """
+    Hashes an image, streams its base64 encoding to disk and collects its metadata.
+
+    The file is mapped once: hashing, the manifest check and encoding all work
+    on the same mapping. Content already in the manifest, or being encoded by
+    another worker in this run, is not encoded again.
+
+    Runs inside a worker process, so it only takes and returns picklable values.
+
+    :param image_path: Path to the image file
+    :param output_dir: Directory where the .b64 file is written
+    :return: Manifest entry for the image with a "status" of encoded, skipped or duplicate
+    """
+    image_file, mapped = _open_mapped(image_path)
     try:
-        # Encode image to base64
-        encoded_image = encode_image_to_base64(image_path)
-        print("Base64 Encoded Image:")
-        print(encoded_image)
-        
-        # Save image bytes to file
-        save_image_bytes(image_path, output_path)
-    except Exception as e:
-        print(f"Error: {e}")
+        data = mapped if mapped is not None else b""
+        sha256 = hashlib.sha256(data).hexdigest()
+        output_path = os.path.join(output_dir, f"{sha256}.b64")
+        entry = {
+            "path": image_path,
+            "sha256": sha256,
+            "size": len(data),
+            "dimensions": read_image_dimensions(data),
+            "output": output_path,
+        }
+
+        if sha256 in _known_hashes and os.path.exists(output_path):
+            entry["status"] = "skipped"
+            return entry
+
+        # Claim the hash so identical files in the same run are encoded once
+        claim_path = f"{output_path}.claim"
+        try:
+            os.close(os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            entry["status"] = "duplicate"
+            return entry
+
+        try:
+            tmp_path = f"{output_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as output_file:
+                for chunk in iter_base64_chunks(data):
+                    output_file.write(chunk)
+            os.replace(tmp_path, output_path)
+        except Exception:
+            # Let a later run retry this content
+            os.remove(claim_path)
+            raise
+
+        entry["status"] = "encoded"
+        return entry
+    finally:
+        if mapped is not None:
+            mapped.close()
+        image_file.close()
+
+def find_images(paths, extensions=IMAGE_EXTENSIONS):
+    """
+    Collects image files from a mix of file and directory paths.
+
+    :param paths: Files or directories to scan (directories are walked recursively)
+    :param extensions: Lower-case file extensions to include
+    :return: Tuple of (sorted image paths, input paths that do not exist)
+    """
+    found = set()
+    missing = []
+    for path in paths:
+        if os.path.isfile(path):
+            found.add(os.path.abspath(path))
+            continue
+        if not os.path.isdir(path):
+            missing.append(path)
+            continue
+        for root, _, files in os.walk(path):
+            for name in files:
+                if name.lower().endswith(extensions):
+                    found.add(os.path.abspath(os.path.join(root, name)))
+    return sorted(found), missing
+
+def load_manifest(manifest_path):
+    """
+    Loads an existing manifest, or returns an empty one.
+
+    :param manifest_path: Path to the manifest JSON file
+    :return: Manifest dict keyed by content hash
+    """
+    if not os.path.exists(manifest_path):
+        return {"files": {}}
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+def save_manifest(manifest, manifest_path):
+    """
+    Writes the manifest atomically so an interrupted run never leaves it half-written.
+
+    :param manifest: Manifest dict
+    :param manifest_path: Path to the manifest JSON file
+    """
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+def _remove_claims(output_dir):
+    for name in os.listdir(output_dir):
+        if name.endswith(".claim"):
+            os.remove(os.path.join(output_dir, name))
+
+def encode_batch(paths, output_dir, workers=None, force=False):
+    """
+    Encodes every image under the given paths across a process pool.
+
+    Files whose content hash is already in the manifest are skipped unless
+    force is set. Each manifest entry lists every input path with that content.
+
+    :param paths: Files or directories to process
+    :param output_dir: Directory for .b64 outputs and the manifest
+    :param workers: Number of worker processes (defaults to the CPU count)
+    :param force: Re-encode files even if their hash is already known
+    :return: Tuple of (encoded entries, skipped paths, failed paths)
+    """
+    output_dir = os.path.abspath(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    known = manifest.setdefault("files", {})
+
+    # Claims left behind by an interrupted run would block those hashes forever
+    _remove_claims(output_dir)
+
+    image_paths, missing = find_images(paths)
+    encoded, skipped, failed = [], [], []
+    for path in missing:
+        print(f"❌ {path}: no such file or directory")
+        failed.append(path)
+
+    known_hashes = () if force else tuple(known)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(known_hashes,)) as executor:
+        futures = {executor.submit(process_image_file, p, output_dir): p for p in image_paths}
+        for future in as_completed(futures):
+            image_path = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"❌ {image_path}: {type(e).__name__} - {str(e)}")
+                failed.append(image_path)
+                continue
+
+            status = result.pop("status")
+            path = result.pop("path")
+            entry = known.setdefault(result["sha256"], dict(result, paths=[]))
+            if status == "encoded":
+                entry.update(result)
+                encoded.append(dict(result, path=path))
+            else:
+                skipped.append(path)
+            if path not in entry["paths"]:
+                entry["paths"].append(path)
+                entry["paths"].sort()
+
+    _remove_claims(output_dir)
+    save_manifest(manifest, manifest_path)
+    print(f"✅ Encoded {len(encoded)} files, skipped {len(skipped)}, failed {len(failed)} -> {manifest_path}")
+    return encoded, skipped, failed
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch base64 encode images and write a content-hash manifest.")
+    parser.add_argument("paths", nargs="*", help="Image files or directories to process")
+    parser.add_argument("-o", "--output-dir", default="encoded_images", help="Directory for .b64 outputs and manifest.json")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Number of worker processes (default: CPU count)")
+    parser.add_argument("--force", action="store_true", help="Re-encode files already present in the manifest")
+    args = parser.parse_args()
+
+    if not args.paths:
+        # Single-file interactive mode, kept for quick manual checks
+        image_path = input("Enter the path to the image: ")
+        output_path = "image_bytes.bin"  # Default output file
+        try:
+            encoded_image = encode_image_to_base64(image_path)
+            print("Base64 Encoded Image:")
+            print(encoded_image)
+
+            save_image_bytes(image_path, output_path)
+        except Exception as e:
+            print(f"Error: {e}")
+        return
+
+    _, _, failed = encode_batch(args.paths, args.output_dir, workers=args.workers, force=args.force)
+    if failed:
+        raise SystemExit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
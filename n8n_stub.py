@@ -0,0 +1,75 @@
+"""
+Local stand-in for the n8n webhooks, for testing without a real workflow.
+
+Run it next to the backend:
+
+    uvicorn n8n_stub:app --port 5678
+    N8N_WEBHOOK_URL=http://127.0.0.1:5678/webhook/story-board \
+    N8N_REGENERATE_WEBHOOK_URL=http://127.0.0.1:5678/webhook/regenerate \
+    N8N_CALLBACK_BASE_URL=http://127.0.0.1:8000 \
+    N8N_CALLBACK_SECRET=dev-secret \
+    uvicorn app.main:app --port 8000
+
+With callback settings the backend answers 202 and the result appears at the
+returned status_url. Without them the stub answers synchronously like n8n does today.
+"""
+import asyncio
+import os
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import Response
+
+app = FastAPI()
+
+# Image returned as the generated result
+STUB_IMAGE_PATH = os.getenv("STUB_IMAGE_PATH", "test.png")
+# Seconds to "generate" before answering or calling back
+STUB_DELAY = float(os.getenv("STUB_DELAY", "2"))
+# Send every callback twice to exercise duplicate handling
+STUB_DUPLICATE_CALLBACKS = os.getenv("STUB_DUPLICATE_CALLBACKS", "0") == "1"
+
+
+def _stub_image():
+    with open(STUB_IMAGE_PATH, "rb") as f:
+        return f.read()
+
+
+async def _call_back(callback_url, correlation_id):
+    await asyncio.sleep(STUB_DELAY)
+    image_bytes = _stub_image()
+    attempts = 2 if STUB_DUPLICATE_CALLBACKS else 1
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        for _ in range(attempts):
+            try:
+                response = await client.post(
+                    callback_url,
+                    content=image_bytes,
+                    headers={"content-type": "image/png"}
+                )
+                print(f"📤 Callback {correlation_id}: {response.status_code} {response.text}")
+            except httpx.RequestError as e:
+                print(f"❌ Callback {correlation_id} failed: {str(e)}")
+
+
+async def _handle(request: Request):
+    form = await request.form()
+    callback_url = form.get("callback_url")
+    correlation_id = form.get("correlation_id")
+
+    if callback_url:
+        asyncio.create_task(_call_back(callback_url, correlation_id))
+        return {"accepted": True, "correlation_id": correlation_id}
+
+    await asyncio.sleep(STUB_DELAY)
+    return Response(content=_stub_image(), media_type="image/png")
+
+
+@app.post("/webhook/story-board")
+async def story_board(request: Request):
+    return await _handle(request)
+
+
+@app.post("/webhook/regenerate")
+async def regenerate(request: Request):
+    return await _handle(request)